@@ -1,18 +1,28 @@
 from __future__ import annotations
 
 from airflow import DAG
-from airflow.operators.python import PythonOperator, ShortCircuitOperator
+from airflow.decorators import task
+from airflow.operators.python import ShortCircuitOperator
 from airflow.operators.email import EmailOperator
 from airflow.providers.postgres.hooks.postgres import PostgresHook
+from psycopg2.extras import execute_values
 
 from datetime import datetime
+import csv
+import io
 import time
 import requests
-import json
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+import orjson
+import numpy as np
 import pandas as pd
 import joblib
+from scipy import sparse
 import boto3
 import os
+import tarfile
+import tempfile
 
 
 # -----------------------
@@ -20,11 +30,57 @@ import os
 # -----------------------
 API_URL = "https://sdacelo-real-time-fraud-detection.hf.space/current-transactions"
 PREPROCESS_PATH = "/opt/airflow/artifacts/preprocess.joblib"
+MODEL_PATH = "/opt/airflow/artifacts/model.xgb"
 
 FRAUD_THRESHOLD = float(os.getenv("FRAUD_THRESHOLD", "0.5"))
 
+# Nombre max de transactions traitées par run du DAG
+BATCH_SIZE = int(os.getenv("BATCH_SIZE", "100"))
+# Taille des shards du batch : 1 shard = 1 task instance mappée
+SHARD_SIZE = int(os.getenv("SHARD_SIZE", "25"))
+
+# Pools Airflow (cf. docker-compose) : scoring local (CPU) vs endpoint SageMaker
+CPU_POOL = "cpu_pool"
+SAGEMAKER_POOL = "sagemaker_pool"
+
+# Scoring : "local" (Booster XGBoost dans le worker) ou "sagemaker" (endpoint, fallback)
+SCORING_BACKEND = os.getenv("SCORING_BACKEND", "local")
+# Features envoyées en sparse (csr / libsvm) sans densification.
+# XGBoost traite une entrée absente comme "missing" et non comme 0 :
+# à activer uniquement avec un modèle entraîné sur des données sparse (libsvm).
+SPARSE_SCORING = os.getenv("SPARSE_SCORING", "false").lower() == "true"
+
 AWS_REGION = os.getenv("AWS_REGION", "eu-west-3")
 SAGEMAKER_ENDPOINT_NAME = os.getenv("SAGEMAKER_ENDPOINT_NAME", "fraud-xgb-rt-eu-west-3")
+# model.tar.gz du training job, téléchargé si MODEL_PATH est absent
+MODEL_S3_URI = os.getenv("MODEL_S3_URI")
+
+# Colonnes non utilisées par le preprocessor
+DROP_COLS = [
+    "is_fraud",
+    "current_time",
+    "trans_date_trans_time",
+    "unix_time",
+    "first",
+    "last",
+    "street",
+    "city",
+    "dob",
+    "trans_num",
+    "cc_num",
+]
+
+# Types des colonnes numériques attendues par le preprocessor, identiques
+# à ceux passés au fit_transform dans preprocessing.py (tout en float32)
+DTYPE_MAP = {
+    "amt": "float32",
+    "zip": "float32",
+    "lat": "float32",
+    "long": "float32",
+    "city_pop": "float32",
+    "merch_lat": "float32",
+    "merch_long": "float32",
+}
 
 # Email (via Airflow SMTP Connection)
 SMTP_CONN_ID = os.getenv("SMTP_CONN_ID", "smtp_gmail")
@@ -35,113 +91,244 @@ def log_step(msg: str):
     print(f"\n==================== {msg} ====================\n")
 
 
+# -----------------------
+# Cache par process : avec le LocalExecutor chaque task instance tourne dans
+# son propre process, le chargement a donc lieu au plus une fois par task
+# -----------------------
+_PREPROC = None
+_SMR = None
+_BST = None
+
+# Session HTTP keep-alive (évite un handshake TLS par appel à l'API)
+_SESSION = requests.Session()
+_SESSION.mount(
+    "https://",
+    HTTPAdapter(
+        pool_connections=4,
+        pool_maxsize=8,
+        max_retries=Retry(total=3, backoff_factor=0.5, status_forcelist=[502, 503, 504]),
+    ),
+)
+
+
+def _get_preproc():
+    global _PREPROC
+    if _PREPROC is None:
+        # mmap_mode : sans effet sur l'artefact actuel (seuls tableaux = categories_
+        # de l'OneHotEncoder, dtype object, non mappables) ; utile si l'artefact
+        # embarque un jour de gros tableaux numériques
+        _PREPROC = joblib.load(PREPROCESS_PATH, mmap_mode="r")
+    return _PREPROC
+
+
+def _get_smr():
+    global _SMR
+    if _SMR is None:
+        _SMR = boto3.client("sagemaker-runtime", region_name=AWS_REGION)
+    return _SMR
+
+
+def _download_model():
+    if not MODEL_S3_URI:
+        raise ValueError(f"{MODEL_PATH} not found and MODEL_S3_URI is not set")
+
+    bucket, _, key = MODEL_S3_URI[len("s3://"):].partition("/")
+    buf = io.BytesIO()
+    boto3.client("s3", region_name=AWS_REGION).download_fileobj(bucket, key, buf)
+    buf.seek(0)
+
+    # Le container XGBoost built-in sauvegarde le modèle sous "xgboost-model"
+    with tarfile.open(fileobj=buf, mode="r:gz") as tar:
+        model = tar.extractfile("xgboost-model").read()
+
+    # Écriture atomique : plusieurs task instances mappées peuvent télécharger
+    # en parallèle, aucune ne doit lire un fichier partiellement écrit
+    with tempfile.NamedTemporaryFile(dir=os.path.dirname(MODEL_PATH), delete=False) as f:
+        f.write(model)
+        tmp_path = f.name
+    os.replace(tmp_path, MODEL_PATH)
+
+
+def _get_booster():
+    global _BST
+    if _BST is None:
+        import xgboost as xgb
+
+        if not os.path.exists(MODEL_PATH):
+            _download_model()
+        _BST = xgb.Booster()
+        _BST.load_model(MODEL_PATH)
+    return _BST
+
+
 # -----------------------
 # Tasks
 # -----------------------
+@task
 def extract_validate():
     log_step("START EXTRACT")
     time.sleep(2)
 
-    r = requests.get(API_URL, headers={"accept": "application/json"}, timeout=20)
-    r.raise_for_status()
-
-    # L'API renvoie un JSON encodé dans une string JSON
-    data = json.loads(json.loads(r.text))
-    df = pd.DataFrame(data["data"], columns=data["columns"])
-
-    if df.empty:
+    # On poll l'API jusqu'à BATCH_SIZE transactions, ou jusqu'à ce qu'elle
+    # ne renvoie plus de nouvelles transactions
+    columns = None
+    rows = []
+    seen = set()
+    while len(seen) < BATCH_SIZE:
+        r = _SESSION.get(
+            API_URL,
+            params={"limit": BATCH_SIZE - len(seen)},
+            headers={"accept": "application/json"},
+            timeout=20,
+        )
+        r.raise_for_status()
+
+        # L'API renvoie un JSON encodé dans une string JSON : 2e décodage
+        # seulement si nécessaire (orjson, directement sur les bytes)
+        data = orjson.loads(r.content)
+        if isinstance(data, (str, bytes)):
+            data = orjson.loads(data)
+
+        if columns is None:
+            columns = data["columns"]
+            if "trans_num" not in columns:
+                raise ValueError("Missing trans_num in payload")
+            trans_idx = columns.index("trans_num")
+        elif data["columns"] != columns:
+            raise ValueError("API returned inconsistent columns between calls")
+
+        new_rows = 0
+        for values in data["data"]:
+            trans_num = values[trans_idx]
+            if not trans_num:
+                raise ValueError("Missing trans_num in payload")
+            if trans_num not in seen:
+                seen.add(trans_num)
+                rows.append(values)
+                new_rows += 1
+
+        if new_rows == 0:
+            break
+
+    if not rows:
         raise ValueError("API returned empty dataframe")
 
-    row = df.iloc[0].to_dict()
-    trans_num = row.get("trans_num")
-    if not trans_num:
-        raise ValueError("Missing trans_num in payload")
+    # Payload colonnaire de l'API conservé tel quel : {columns, rows}
+    shards = [
+        {"columns": columns, "rows": rows[i:i + SHARD_SIZE]}
+        for i in range(0, len(rows), SHARD_SIZE)
+    ]
 
-    log_step(f"DONE EXTRACT - trans_num={trans_num}")
-    return {"trans_num": trans_num, "row": row}
+    log_step(f"DONE EXTRACT - {len(rows)} transaction(s), {len(shards)} shard(s)")
+    return shards
 
 
-def transform(ti):
-    log_step("START TRANSFORM")
-    time.sleep(2)
+def _transform(shard: dict):
+    # Un seul DataFrame par shard, directement avec les types attendus
+    df = pd.DataFrame(shard["rows"], columns=shard["columns"])
+    df = df.astype({c: t for c, t in DTYPE_MAP.items() if c in df.columns})
 
-    x = ti.xcom_pull(task_ids="extract_validate")
-    row = x["row"]
-
-    df = pd.DataFrame([row])
-
-    X = df.drop(
-        columns=[
-            "is_fraud",
-            "current_time",
-            "trans_date_trans_time",
-            "unix_time",
-            "first",
-            "last",
-            "street",
-            "city",
-            "dob",
-            "trans_num",
-            "cc_num",
-        ],
-        errors="ignore",
-    )
+    X = df.drop(columns=DROP_COLS, errors="ignore")
 
     if "gender" in X.columns:
         X["gender"] = X["gender"].map({"M": 0, "F": 1})
 
-    preprocessor = joblib.load(PREPROCESS_PATH)
-    Xt = preprocessor.transform(X)
+    # Un seul transform sur tout le shard (sklearn vectorise sur les lignes)
+    preprocessor = _get_preproc()
+    return preprocessor.transform(X)
 
-    if hasattr(Xt, "toarray"):
-        dense = Xt.toarray()[0]
-    else:
-        dense = Xt[0]
 
-    log_step(f"DONE TRANSFORM - shape={getattr(Xt, 'shape', None)}")
-    csv_line = ",".join(str(float(v)) for v in dense)
+def _score_local(X) -> list:
+    # inplace_predict accepte une matrice dense ou une csr_matrix
+    return _get_booster().inplace_predict(X).tolist()
 
-    return {"trans_num": x["trans_num"], "row": row, "csv_line": csv_line}
 
+def _to_csv(dense: np.ndarray) -> bytes:
+    # CSV multi-lignes formaté en C (np.savetxt) ; %.9g suffit pour
+    # restituer exactement un float32
+    buf = io.BytesIO()
+    np.savetxt(buf, dense.astype(np.float32, copy=False), delimiter=",", fmt="%.9g")
+    return buf.getvalue()
 
-def score_sagemaker(ti):
-    log_step("START SCORE (SAGEMAKER)")
-    time.sleep(2)
 
-    x = ti.xcom_pull(task_ids="transform")
-    csv_line = x["csv_line"]
+def _to_libsvm(X: sparse.csr_matrix) -> bytes:
+    # Import local : chemin opt-in, évité au parsing du DAG par le scheduler
+    from sklearn.datasets import dump_svmlight_file
+
+    # Seules les valeurs non nulles sont encodées
+    buf = io.BytesIO()
+    dump_svmlight_file(X, np.zeros(X.shape[0]), buf, zero_based=True)
+    return buf.getvalue()
 
-    smr = boto3.client("sagemaker-runtime", region_name=AWS_REGION)
+
+def _score_sagemaker(X) -> list:
+    # 1 seul appel par shard
+    if sparse.issparse(X):
+        content_type, payload = "text/libsvm", _to_libsvm(X)
+    else:
+        content_type, payload = "text/csv", _to_csv(X)
+
+    smr = _get_smr()
     resp = smr.invoke_endpoint(
         EndpointName=SAGEMAKER_ENDPOINT_NAME,
-        ContentType="text/csv",
-        Body=csv_line.encode("utf-8"),
+        ContentType=content_type,
+        Body=payload,
     )
 
-    body = resp["Body"].read().decode("utf-8").strip()
-    fraud_proba = float(body)
-    fraud_flag = fraud_proba >= FRAUD_THRESHOLD
-
-    log_step(f"DONE SCORE (SAGEMAKER) - proba={fraud_proba:.4f} flag={fraud_flag}")
-    return {
-        "trans_num": x["trans_num"],
-        "row": x["row"],
-        "fraud_proba": fraud_proba,
-        "fraud_flag": fraud_flag,
-        "model_version": "xgb-rt",
-    }
+    body = resp["Body"].read().decode("utf-8")
+    return [float(v) for v in body.replace("\n", ",").split(",") if v.strip()]
 
 
-def load_to_postgres(ti):
-    log_step("START LOAD (POSTGRES UPSERT)")
+@task(pool=SAGEMAKER_POOL if SCORING_BACKEND == "sagemaker" else CPU_POOL)
+def transform_score(shard: dict):
+    log_step(f"START TRANSFORM + SCORE ({SCORING_BACKEND.upper()})")
     time.sleep(2)
 
-    x = ti.xcom_pull(task_ids="score_sagemaker")
+    # Transform et score dans la même task : les features restent en mémoire
+    # (pas de passage par XCom)
+    Xt = _transform(shard)
+
+    if SPARSE_SCORING and sparse.issparse(Xt):
+        X = sparse.csr_matrix(Xt, dtype=np.float32)
+    elif hasattr(Xt, "toarray"):
+        X = Xt.toarray().astype(np.float32)
+    else:
+        X = np.asarray(Xt, dtype=np.float32)
+
+    if SCORING_BACKEND == "sagemaker":
+        probas = _score_sagemaker(X)
+    else:
+        probas = _score_local(X)
+
+    columns, rows = shard["columns"], shard["rows"]
+    if len(probas) != len(rows):
+        raise ValueError(f"Model returned {len(probas)} scores for {len(rows)} rows")
+
+    scored = []
+    for values, fraud_proba in zip(rows, probas):
+        row = dict(zip(columns, values))
+        scored.append({
+            "trans_num": row["trans_num"],
+            "row": row,
+            "fraud_proba": fraud_proba,
+            "fraud_flag": fraud_proba >= FRAUD_THRESHOLD,
+            "model_version": "xgb-rt",
+        })
+
+    n_frauds = sum(s["fraud_flag"] for s in scored)
+    log_step(
+        f"DONE TRANSFORM + SCORE - shape={getattr(Xt, 'shape', None)} "
+        f"{len(scored)} scored, {n_frauds} flagged"
+    )
+    return scored
+
+
+def _upsert_params(x: dict) -> dict:
     row = x["row"]
     event_time = row.get("current_time")
     event_time = int(event_time)
 
-    params = {
+    return {
         "trans_num": x["trans_num"],
         "event_time": event_time,
         "cc_num": str(row.get("cc_num")) if row.get("cc_num") is not None else None,
@@ -167,19 +354,14 @@ def load_to_postgres(ti):
         "model_version": x["model_version"],
     }
 
-    hook = PostgresHook(postgres_conn_id="payments_pg")
 
-    sql = """
-    INSERT INTO public.payments_scored (
-        trans_num, event_time, cc_num, merchant, category, amt, first, last, gender,
-        street, city, state, zip, lat, long, city_pop, job, dob, merch_lat, merch_long,
-        fraud_proba, fraud_flag, model_version
-    )
-    VALUES (
-        %(trans_num)s, %(event_time)s, %(cc_num)s, %(merchant)s, %(category)s, %(amt)s, %(first)s, %(last)s, %(gender)s,
-        %(street)s, %(city)s, %(state)s, %(zip)s, %(lat)s, %(long)s, %(city_pop)s, %(job)s, %(dob)s, %(merch_lat)s, %(merch_long)s,
-        %(fraud_proba)s, %(fraud_flag)s, %(model_version)s
-    )
+UPSERT_COLUMNS = [
+    "trans_num", "event_time", "cc_num", "merchant", "category", "amt", "first", "last", "gender",
+    "street", "city", "state", "zip", "lat", "long", "city_pop", "job", "dob", "merch_lat", "merch_long",
+    "fraud_proba", "fraud_flag", "model_version",
+]
+
+ON_CONFLICT_UPDATE = """
     ON CONFLICT (trans_num)
     DO UPDATE SET
         event_time    = EXCLUDED.event_time,
@@ -204,25 +386,141 @@ def load_to_postgres(ti):
         fraud_proba   = EXCLUDED.fraud_proba,
         fraud_flag    = EXCLUDED.fraud_flag,
         model_version = EXCLUDED.model_version,
-        ingested_at   = now();
-    """
+        ingested_at   = now()
+"""
+
+# Au-delà de ce seuil, on passe par COPY dans une table de staging
+COPY_THRESHOLD = 1024
+COPY_NULL = "\\N"
+
+
+def _upsert_values(cur, values: list):
+    columns = ", ".join(UPSERT_COLUMNS)
+    template = "(" + ", ".join(["%s"] * len(UPSERT_COLUMNS)) + ")"
+    sql = f"INSERT INTO public.payments_scored ({columns}) VALUES %s {ON_CONFLICT_UPDATE}"
+
+    execute_values(cur, sql, values, template=template, page_size=1000)
+
+
+def _upsert_copy(cur, values: list):
+    columns = ", ".join(UPSERT_COLUMNS)
+
+    # csv.writer écrit None et "" de la même façon : marqueur NULL explicite
+    # pour stocker les mêmes valeurs que le chemin execute_values
+    buf = io.StringIO()
+    csv.writer(buf).writerows(
+        tuple(COPY_NULL if v is None else v for v in row) for row in values
+    )
+    buf.seek(0)
+
+    cur.execute(
+        "CREATE TEMP TABLE payments_stage "
+        "(LIKE public.payments_scored INCLUDING DEFAULTS) ON COMMIT DROP"
+    )
+    cur.copy_expert(
+        f"COPY payments_stage ({columns}) FROM STDIN WITH (FORMAT csv, NULL '{COPY_NULL}')", buf
+    )
+    cur.execute(
+        f"INSERT INTO public.payments_scored ({columns}) "
+        f"SELECT {columns} FROM payments_stage {ON_CONFLICT_UPDATE}"
+    )
+
+
+@task
+def load_to_postgres(scored_shards):
+    log_step("START LOAD (POSTGRES UPSERT)")
+    time.sleep(2)
 
-    hook.run(sql, parameters=params)
+    # Agrégation des sorties des task instances mappées
+    params = [_upsert_params(x) for scored in scored_shards for x in scored]
+    values = [tuple(p[c] for c in UPSERT_COLUMNS) for p in params]
 
-    log_step(f"DONE LOAD - upsert trans_num={params['trans_num']}")
+    hook = PostgresHook(postgres_conn_id="payments_pg")
+
+    # Un seul upsert pour tout le batch, commit unique
+    conn = hook.get_conn()
+    try:
+        with conn.cursor() as cur:
+            # Journées impactées pour les KPI : celles que quittent les trans_num
+            # déjà présents (ingested_at est déplacé à now() par l'upsert)
+            # + celle de l'ingestion (now() = début de cette transaction)
+            cur.execute(
+                """
+                SELECT DISTINCT DATE(ingested_at) FROM public.payments_scored
+                WHERE trans_num = ANY(%s)
+                UNION
+                SELECT DATE(now())
+                """,
+                ([p["trans_num"] for p in params],),
+            )
+            kpi_days = sorted(day.isoformat() for (day,) in cur.fetchall() if day is not None)
+
+            if len(values) > COPY_THRESHOLD:
+                _upsert_copy(cur, values)
+            else:
+                _upsert_values(cur, values)
+        conn.commit()
+    finally:
+        conn.close()
+
+    frauds = [
+        {"trans_num": p["trans_num"], "fraud_proba": p["fraud_proba"]}
+        for p in params
+        if p["fraud_flag"]
+    ]
+
+    log_step(f"DONE LOAD - upsert {len(params)} row(s), {len(frauds)} fraud(s)")
     return {
-        "trans_num": params["trans_num"],
-        "fraud_flag": params["fraud_flag"],
-        "fraud_proba": params["fraud_proba"],
+        "n_rows": len(params),
+        "frauds": frauds,
+        "kpi_days": kpi_days,
     }
 
 
+@task
+def update_daily_kpi(loaded: dict):
+    log_step("START UPDATE DAILY KPI")
+
+    # Recalcul complet des journées touchées par le load (LEFT JOIN : une
+    # journée vidée par un reprocessing retombe à 0)
+    sql = """
+    INSERT INTO public.payments_daily_kpi (day, total_payments, total_frauds, fraud_amount)
+    SELECT
+        d.day,
+        COUNT(p.trans_num) AS total_payments,
+        COUNT(p.trans_num) FILTER (WHERE p.fraud_flag IS TRUE) AS total_frauds,
+        COALESCE(SUM(p.amt) FILTER (WHERE p.fraud_flag IS TRUE), 0) AS fraud_amount
+    FROM unnest(%s::date[]) AS d(day)
+    LEFT JOIN public.payments_scored p
+        ON p.ingested_at >= d.day
+       AND p.ingested_at < d.day + 1
+    GROUP BY d.day
+    ON CONFLICT (day)
+    DO UPDATE SET
+        total_payments = EXCLUDED.total_payments,
+        total_frauds   = EXCLUDED.total_frauds,
+        fraud_amount   = EXCLUDED.fraud_amount;
+    """
+
+    hook = PostgresHook(postgres_conn_id="payments_pg")
+
+    conn = hook.get_conn()
+    try:
+        with conn.cursor() as cur:
+            cur.execute(sql, (loaded["kpi_days"],))
+        conn.commit()
+    finally:
+        conn.close()
+
+    log_step(f"DONE UPDATE DAILY KPI - day(s)={loaded['kpi_days']}")
+
+
 def is_fraud(ti) -> bool:
     """
     Gate task: si False => l'EmailOperator downstream sera SKIPPED
     """
     x = ti.xcom_pull(task_ids="load_to_postgres")
-    return bool(x["fraud_flag"])
+    return bool(x["frauds"])
 
 
 # -----------------------
@@ -238,26 +536,27 @@ with DAG(
     tags=["fraud", "mlops"],
     default_args=default_args,
     max_active_runs=1,
-    max_active_tasks=1,
 ) as dag:
 
-    t1 = PythonOperator(task_id="extract_validate", python_callable=extract_validate)
-    t2 = PythonOperator(task_id="transform", python_callable=transform)
-    t3 = PythonOperator(task_id="score_sagemaker", python_callable=score_sagemaker)
-    t4 = PythonOperator(task_id="load_to_postgres", python_callable=load_to_postgres)
+    t1 = extract_validate()
+    t2 = transform_score.expand(shard=t1)
+    t3 = load_to_postgres(t2)
 
-    t5 = ShortCircuitOperator(task_id="is_fraud", python_callable=is_fraud)
+    t4 = ShortCircuitOperator(task_id="is_fraud", python_callable=is_fraud)
 
-    t6 = EmailOperator(
+    t5 = EmailOperator(
         task_id="send_fraud_email",
         to=ALERT_EMAIL_TO,
-        subject="Alerte paiement frauduleux - trans_num={{ ti.xcom_pull(task_ids='load_to_postgres')['trans_num'] }}",
+        subject="Alerte paiement frauduleux - {{ ti.xcom_pull(task_ids='load_to_postgres')['frauds'] | length }} transaction(s) suspecte(s)",
         html_content="""
         <p>Bonjour,</p>
-        <p><b>Transaction suspecte détectée</b></p>
+        <p><b>Transaction(s) suspecte(s) détectée(s)</b></p>
+        <ul>
+        {% for f in ti.xcom_pull(task_ids='load_to_postgres')['frauds'] %}
+          <li>trans_num: {{ f['trans_num'] }} - fraud_proba: {{ '%.4f' | format(f['fraud_proba']) }}</li>
+        {% endfor %}
+        </ul>
         <ul>
-          <li>trans_num: {{ ti.xcom_pull(task_ids='load_to_postgres')['trans_num'] }}</li>
-          <li>fraud_proba: {{ '%.4f' | format(ti.xcom_pull(task_ids='load_to_postgres')['fraud_proba']) }}</li>
           <li>threshold: {{ params.threshold }}</li>
           <li>model_version: xgb-rt</li>
         </ul>
@@ -266,4 +565,6 @@ with DAG(
         params={"threshold": FRAUD_THRESHOLD},
     )
 
-    t1 >> t2 >> t3 >> t4 >> t5 >> t6
+    t6 = update_daily_kpi(t3)
+
+    t3 >> t4 >> t5
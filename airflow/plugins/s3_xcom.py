@@ -0,0 +1,91 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+import io
+import os
+
+import boto3
+import pandas as pd
+from airflow.models.xcom import BaseXCom
+
+
+# -----------------------
+# Config
+# -----------------------
+XCOM_S3_BUCKET = os.getenv("XCOM_S3_BUCKET", "automated-fraud-detection")
+# Objets supprimés via S3XCom.purge quand la ligne XCom est effacée (clear,
+# rerun de task). `airflow db clean` supprime les lignes sans appeler purge :
+# prévoir une règle de lifecycle S3 (expiration) sur ce préfixe
+XCOM_S3_PREFIX = "xcom"
+# Au-delà de cette taille (octets sérialisés), la valeur part sur S3
+XCOM_S3_THRESHOLD = int(os.getenv("XCOM_S3_THRESHOLD", "64000"))
+
+AWS_REGION = os.getenv("AWS_REGION", "eu-west-3")
+
+_S3_URI_PREFIX = f"s3://{XCOM_S3_BUCKET}/{XCOM_S3_PREFIX}/"
+_S3 = None
+
+
+def _s3_key(value):
+    if isinstance(value, str) and value.startswith(_S3_URI_PREFIX):
+        return value[len(f"s3://{XCOM_S3_BUCKET}/"):]
+    return None
+
+
+def _get_s3():
+    global _S3
+    if _S3 is None:
+        _S3 = boto3.client("s3", region_name=AWS_REGION)
+    return _S3
+
+
+class S3XCom(BaseXCom):
+    """
+    XCom backend : les valeurs volumineuses sont stockées sur S3,
+    seule l'URI est écrite dans la base de métadonnées Airflow.
+    Les DataFrames sont toujours stockés en Parquet (zstd).
+    """
+
+    @staticmethod
+    def serialize_value(
+        value,
+        *,
+        key=None,
+        task_id=None,
+        dag_id=None,
+        run_id=None,
+        map_index=None,
+        **kwargs,
+    ):
+        if isinstance(value, pd.DataFrame):
+            buf = io.BytesIO()
+            value.to_parquet(buf, compression="zstd")
+            payload, ext = buf.getvalue(), "parquet"
+        else:
+            payload, ext = BaseXCom.serialize_value(value), "json"
+            if len(payload) <= XCOM_S3_THRESHOLD:
+                return payload
+
+        s3_key = f"{XCOM_S3_PREFIX}/{dag_id}/{run_id}/{task_id}/{map_index}/{key}.{ext}"
+        _get_s3().put_object(Bucket=XCOM_S3_BUCKET, Key=s3_key, Body=payload)
+
+        return BaseXCom.serialize_value(f"s3://{XCOM_S3_BUCKET}/{s3_key}")
+
+    @staticmethod
+    def deserialize_value(result):
+        value = BaseXCom.deserialize_value(result)
+        s3_key = _s3_key(value)
+        if s3_key is None:
+            return value
+
+        body = _get_s3().get_object(Bucket=XCOM_S3_BUCKET, Key=s3_key)["Body"].read()
+
+        if s3_key.endswith(".parquet"):
+            return pd.read_parquet(io.BytesIO(body))
+        return BaseXCom.deserialize_value(SimpleNamespace(value=body))
+
+    @staticmethod
+    def purge(xcom, session=None):
+        s3_key = _s3_key(BaseXCom.deserialize_value(xcom))
+        if s3_key is not None:
+            _get_s3().delete_object(Bucket=XCOM_S3_BUCKET, Key=s3_key)
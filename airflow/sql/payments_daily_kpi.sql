@@ -0,0 +1,29 @@
+-- KPI journaliers pré-agrégés (fraud_db)
+--
+-- Maintenue par la task update_daily_kpi du DAG après chaque load (journées
+-- touchées par le batch) ; l'historique est initialisé par le backfill ci-dessous.
+-- Le dashboard lit une seule ligne par jour au lieu d'agréger payments_scored.
+
+CREATE TABLE IF NOT EXISTS public.payments_daily_kpi (
+    day            date PRIMARY KEY,
+    total_payments bigint  NOT NULL DEFAULT 0,
+    total_frauds   bigint  NOT NULL DEFAULT 0,
+    fraud_amount   numeric NOT NULL DEFAULT 0
+);
+
+-- Backfill ponctuel de l'historique (même calcul que update_daily_kpi,
+-- sans filtre de date) ; idempotent, peut être rejoué.
+INSERT INTO public.payments_daily_kpi (day, total_payments, total_frauds, fraud_amount)
+SELECT
+    DATE(ingested_at) AS day,
+    COUNT(*) AS total_payments,
+    COUNT(*) FILTER (WHERE fraud_flag IS TRUE) AS total_frauds,
+    COALESCE(SUM(amt) FILTER (WHERE fraud_flag IS TRUE), 0) AS fraud_amount
+FROM public.payments_scored
+WHERE ingested_at IS NOT NULL
+GROUP BY DATE(ingested_at)
+ON CONFLICT (day)
+DO UPDATE SET
+    total_payments = EXCLUDED.total_payments,
+    total_frauds   = EXCLUDED.total_frauds,
+    fraud_amount   = EXCLUDED.fraud_amount;
@@ -0,0 +1,17 @@
+-- Index utilisés par le dashboard Streamlit (fraud_db)
+--
+-- Les requêtes filtrent une journée d'ingestion sous forme d'intervalle
+-- (ingested_at >= jour AND ingested_at < jour + 1) : l'index btree est
+-- utilisable, et les colonnes INCLUDE permettent un index-only scan pour les KPI.
+--
+-- CONCURRENTLY : pas de verrou en écriture pendant la création
+-- (à exécuter hors transaction, ex. psql -f).
+
+CREATE INDEX CONCURRENTLY IF NOT EXISTS payments_scored_ingested_at_idx
+    ON public.payments_scored (ingested_at)
+    INCLUDE (fraud_flag, amt);
+
+-- trans_num est la PRIMARY KEY (cible du ON CONFLICT du DAG) : pas d'index
+-- supplémentaire nécessaire. Vérification :
+--   SELECT conname, contype FROM pg_constraint
+--   WHERE conrelid = 'public.payments_scored'::regclass AND contype = 'p';
@@ -1,8 +1,9 @@
 import os
-from datetime import date, timedelta
+from datetime import date, datetime, timedelta
 
 import pandas as pd
 import streamlit as st
+from adbc_driver_postgresql import dbapi as adbc
 from sqlalchemy import create_engine, text
 from sqlalchemy.engine import Engine
 
@@ -25,16 +26,19 @@ def env_required(name: str) -> str:
     return v
 
 
-@st.cache_resource(show_spinner=False)
-def get_engine() -> Engine:
+def pg_url(scheme: str) -> str:
     host = env_required("PGHOST")
     port = os.getenv("PGPORT", "5432")
     db = env_required("PGDATABASE")
     user = env_required("PGUSER")
     password = env_required("PGPASSWORD")
 
-    url = f"postgresql+psycopg2://{user}:{password}@{host}:{port}/{db}"
-    return create_engine(url, pool_pre_ping=True)
+    return f"{scheme}://{user}:{password}@{host}:{port}/{db}"
+
+
+@st.cache_resource(show_spinner=False)
+def get_engine() -> Engine:
+    return create_engine(pg_url("postgresql+psycopg2"), pool_pre_ping=True)
 
 
 engine = get_engine()
@@ -55,37 +59,47 @@ with st.sidebar:
 # -----------------------------
 # Data access
 # -----------------------------
+def day_bounds(day: date) -> tuple:
+    """
+    Intervalle [day, day + 1 jour[ : filtre sargable sur ingested_at (index utilisable).
+    """
+    start = datetime.combine(day, datetime.min.time())
+    return start, start + timedelta(days=1)
+
+
 @st.cache_data(ttl=15, show_spinner=False)
 def load_kpis_for_day(day: date) -> dict:
     """
-    KPI calculés sur la journée d'ingestion (ingested_at) — robuste pour la démo.
+    KPI de la journée d'ingestion, lus dans la table pré-agrégée
+    payments_daily_kpi (maintenue par le DAG).
     """
     q = text("""
-        SELECT
-            COUNT(*)::bigint AS total_payments,
-            COUNT(*) FILTER (WHERE fraud_flag IS TRUE)::bigint AS total_frauds,
-            COALESCE(
-                (COUNT(*) FILTER (WHERE fraud_flag IS TRUE)::numeric / NULLIF(COUNT(*)::numeric, 0)),
-                0
-            ) AS fraud_rate,
-            COALESCE(SUM(amt) FILTER (WHERE fraud_flag IS TRUE), 0) AS fraud_amount
-        FROM public.payments_scored
-        WHERE DATE(ingested_at) = :day
+        SELECT total_payments, total_frauds, fraud_amount
+        FROM public.payments_daily_kpi
+        WHERE day = :day
     """)
     with engine.connect() as conn:
-        row = conn.execute(q, {"day": day}).mappings().one()
+        row = conn.execute(q, {"day": day}).mappings().one_or_none()
+
+    if row is None:
+        return {"total_payments": 0, "total_frauds": 0, "fraud_rate": 0.0, "fraud_amount": 0.0}
 
+    total_payments = int(row["total_payments"])
+    total_frauds = int(row["total_frauds"])
     return {
-        "total_payments": int(row["total_payments"]),
-        "total_frauds": int(row["total_frauds"]),
-        "fraud_rate": float(row["fraud_rate"]),
+        "total_payments": total_payments,
+        "total_frauds": total_frauds,
+        "fraud_rate": total_frauds / total_payments if total_payments else 0.0,
         "fraud_amount": float(row["fraud_amount"]),
     }
 
 
 @st.cache_data(ttl=15, show_spinner=False)
 def load_transactions_for_day(day: date, fraud_only: bool) -> pd.DataFrame:
-    q = text("""
+    """
+    Lecture colonnaire via ADBC (Arrow) plutôt que psycopg2 ligne à ligne.
+    """
+    q = """
         SELECT
             trans_num,
             to_timestamp(event_time) AS event_time,
@@ -97,12 +111,20 @@ def load_transactions_for_day(day: date, fraud_only: bool) -> pd.DataFrame:
             state,
             ingested_at
         FROM public.payments_scored
-        WHERE DATE(ingested_at) = :day
-          AND (:fraud_only = FALSE OR fraud_flag IS TRUE)
+        WHERE ingested_at >= $1
+          AND ingested_at < $2
+          AND ($3 = FALSE OR fraud_flag IS TRUE)
         ORDER BY ingested_at DESC NULLS LAST
-    """)
-    with engine.connect() as conn:
-        df = pd.read_sql(q, conn, params={"day": day, "fraud_only": fraud_only})
+    """
+    day_start, day_end = day_bounds(day)
+    with adbc.connect(pg_url("postgresql")) as conn, conn.cursor() as cur:
+        cur.execute(q, (day_start, day_end, fraud_only))
+        table = cur.fetch_arrow_table()
+
+    # Colonnes Arrow-backed (pas de copie vers des objets Python)
+    df = table.to_pandas(types_mapper=pd.ArrowDtype)
+    for c in ["merchant", "category", "state"]:
+        df[c] = df[c].astype("category")
     return df
 
 
@@ -128,12 +150,9 @@ try:
     if df_day.empty:
         st.info("No transactions for selected date.")
     else:
-        # Parse datetimes
-        df_day["event_time"] = pd.to_datetime(df_day["event_time"], errors="coerce")
-        df_day["ingested_at"] = pd.to_datetime(df_day["ingested_at"], errors="coerce")
-
         # Demo fallback: replace missing event_time by selected date
-        fallback_dt = pd.to_datetime(selected_day)
+        # (event_time / ingested_at arrivent déjà typés timestamp depuis Postgres)
+        fallback_dt = pd.Timestamp(selected_day, tz=df_day["event_time"].dt.tz)
         df_day["event_time"] = df_day["event_time"].fillna(fallback_dt)
 
         st.caption(f"{len(df_day)} transaction(s) for {selected_day}")
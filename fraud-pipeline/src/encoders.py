@@ -1,19 +1,50 @@
+import numpy as np
+import pandas as pd
 from sklearn.base import BaseEstimator, TransformerMixin
-from sklearn.feature_extraction import FeatureHasher
+from sklearn.feature_extraction.text import HashingVectorizer
+
+# Séparateur de tokens : absent des valeurs (qui peuvent contenir des espaces)
+TOKEN_SEP = "\x1f"
+
+
+def split_tokens(doc):
+    return doc.split(TOKEN_SEP)
 
 
 class HashingEncoder(BaseEstimator, TransformerMixin):
-    def __init__(self, n_features=128):
+    # Valeurs par défaut au niveau classe : un artefact picklé avant l'ajout de
+    # ces paramètres reste un estimateur valide (get_params, repr, clone)
+    columns = None
+    dtype = np.float64
+
+    def __init__(self, n_features=128, columns=None, dtype=np.float64):
         self.n_features = n_features
-        self.hasher = FeatureHasher(
-            n_features=n_features,
-            input_type="string"
-        )
+        self.columns = columns
+        self.dtype = dtype
 
     def fit(self, X, y=None):
         return self
 
     def transform(self, X):
-        return self.hasher.transform(
-            X.astype(str).values
+        # Artefact picklé avant le passage à HashingVectorizer :
+        # on garde l'ancien hachage pour rester aligné avec le modèle entraîné dessus
+        if "hasher" in self.__dict__:
+            return self.hasher.transform(np.asarray(X).astype(str))
+
+        if not isinstance(X, pd.DataFrame):
+            X = np.asarray(X)
+            columns = self.columns or [f"x{i}" for i in range(X.shape[1])]
+            X = pd.DataFrame(X, columns=columns)
+
+        # 1 document par ligne : "col=val" pour chaque colonne, hachés en un seul appel
+        tokens = [f"{col}=" + X[col].astype(str) for col in X.columns]
+        docs = tokens[0].str.cat(tokens[1:], sep=TOKEN_SEP) if len(tokens) > 1 else tokens[0]
+
+        vectorizer = HashingVectorizer(
+            n_features=self.n_features,
+            analyzer=split_tokens,
+            alternate_sign=False,
+            norm=None,
+            dtype=self.dtype,
         )
+        return vectorizer.transform(docs.to_numpy())
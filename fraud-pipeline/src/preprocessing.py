@@ -2,6 +2,9 @@ import pandas as pd
 import numpy as np
 import joblib
 import boto3
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from scipy import sparse
 from sklearn.model_selection import train_test_split
 from sklearn.preprocessing import OneHotEncoder
 from sklearn.compose import ColumnTransformer
@@ -20,6 +23,25 @@ TRAIN_OUTPUT = "artifacts/train.csv"
 VAL_OUTPUT = "artifacts/val.csv"
 PREPROCESS_OUTPUT = "artifacts/preprocess.joblib"
 
+# Colonnes texte à faible/moyenne cardinalité converties en category
+CATEGORY_COLUMNS = ["category", "state", "merchant", "job", "gender"]
+
+# Types appliqués directement par le parser CSV (pyarrow)
+CSV_COLUMN_TYPES = {
+    "amt": pa.float32(),
+    "zip": pa.int32(),
+    "city_pop": pa.int32(),
+    "lat": pa.float32(),
+    "long": pa.float32(),
+    "merch_lat": pa.float32(),
+    "merch_long": pa.float32(),
+    # dictionary => pandas category à la conversion
+    **{c: pa.dictionary(pa.int32(), pa.string()) for c in CATEGORY_COLUMNS},
+}
+
+# Nombre de lignes densifiées à la fois lors de l'export CSV
+CSV_CHUNK_SIZE = 50_000
+
 
 # -----------------------------
 # Load data from S3
@@ -27,10 +49,51 @@ PREPROCESS_OUTPUT = "artifacts/preprocess.joblib"
 def load_data():
     s3 = boto3.client("s3")
     obj = s3.get_object(Bucket=S3_BUCKET, Key=S3_KEY)
-    df = pd.read_csv(obj["Body"])
+    # Parsing CSV multithreadé (pyarrow) puis conversion en DataFrame pandas
+    tbl = pacsv.read_csv(
+        obj["Body"],
+        read_options=pacsv.ReadOptions(use_threads=True, block_size=64 * 1024 * 1024),
+        convert_options=pacsv.ConvertOptions(column_types=CSV_COLUMN_TYPES),
+    )
+    df = tbl.to_pandas(date_as_object=False)
+    return downcast_dtypes(df)
+
+
+# -----------------------------
+# Reduce memory footprint
+# -----------------------------
+def downcast_dtypes(df):
+    for c in df.select_dtypes("integer").columns:
+        downcast = "unsigned" if df[c].min() >= 0 else "integer"
+        df[c] = pd.to_numeric(df[c], downcast=downcast)
+
+    for c in df.select_dtypes("float").columns:
+        df[c] = pd.to_numeric(df[c], downcast="float")
+
+    for c in CATEGORY_COLUMNS:
+        if c in df.columns:
+            df[c] = df[c].astype("category")
+
     return df
 
 
+# -----------------------------
+# Save train/val CSV (label first, no header)
+# -----------------------------
+def save_csv(path, y, X, chunk_size=CSV_CHUNK_SIZE):
+    # On garde X sparse et on ne densifie qu'un chunk à la fois ;
+    # le formatage est fait par le writer C de pandas
+    X = sparse.csr_matrix(X)
+    y = np.asarray(y)
+
+    with open(path, "w", newline="") as f:
+        for start in range(0, X.shape[0], chunk_size):
+            stop = start + chunk_size
+            chunk = pd.DataFrame(X[start:stop].toarray())
+            chunk.insert(0, "label", y[start:stop])
+            chunk.to_csv(f, header=False, index=False, float_format="%.10g")
+
+
 # -----------------------------
 # Main
 # -----------------------------
@@ -70,14 +133,19 @@ if __name__ == "__main__":
 
     preprocessor = ColumnTransformer(
         transformers=[
-            ("low_cat", OneHotEncoder(handle_unknown="ignore"), categorical_low),
-            ("high_cat", HashingEncoder(n_features=128), categorical_high),
+            ("low_cat", OneHotEncoder(handle_unknown="ignore", dtype=np.float32), categorical_low),
+            ("high_cat", HashingEncoder(n_features=128, columns=categorical_high, dtype=np.float32), categorical_high),
             ("num", "passthrough", numeric_features)
         ]
     )
 
+    # Passthrough en float32 : un uint32 (zip, city_pop) ferait remonter toute
+    # la matrice en float64 ; les deux restent exacts en float32 (< 2^24)
+    X[numeric_features] = X[numeric_features].astype(np.float32)
+
     print("Applying preprocessing...")
     X_processed = preprocessor.fit_transform(X)
+    print(f"Processed matrix: shape={X_processed.shape} dtype={X_processed.dtype}")
 
     # Train/Validation split
     X_train, X_val, y_train, y_val = train_test_split(
@@ -88,15 +156,12 @@ if __name__ == "__main__":
         random_state=42
     )
 
-    # Convert to numpy and stack label first
-    train_array = np.column_stack((y_train.values, X_train.toarray() if hasattr(X_train, "toarray") else X_train))
-    val_array = np.column_stack((y_val.values, X_val.toarray() if hasattr(X_val, "toarray") else X_val))
-
     print("Saving train/val CSV...")
-    np.savetxt(TRAIN_OUTPUT, train_array, delimiter=",", fmt="%s")
-    np.savetxt(VAL_OUTPUT, val_array, delimiter=",", fmt="%s")
+    save_csv(TRAIN_OUTPUT, y_train, X_train)
+    save_csv(VAL_OUTPUT, y_val, X_val)
 
     print("Saving preprocessing artifact...")
+    # Non compressé : reste compatible avec mmap_mode côté Airflow
     joblib.dump(preprocessor, PREPROCESS_OUTPUT)
 
     print("Done.")
@@ -3,6 +3,9 @@ from sagemaker.image_uris import retrieve
 from sagemaker.estimator import Estimator
 from sagemaker.inputs import TrainingInput
 import boto3
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pyarrow.fs as pafs
 
 REGION = "eu-west-3"
 ROLE_ARN = "arn:aws:iam::891084863160:role/service-role/SageMaker-FraudProject"
@@ -17,25 +20,26 @@ def compute_scale_pos_weight(s3_uri: str) -> float:
     """
     Compute scale_pos_weight = (#negative / #positive) from train.csv on S3.
     train.csv format: label is first column, no header.
+    Only the label column is converted (multithreaded pyarrow CSV reader).
     """
-    s3 = boto3.client("s3", region_name=REGION)
-    # parse s3://bucket/key
+    fs = pafs.S3FileSystem(region=REGION)
+    # s3://bucket/key -> bucket/key
     assert s3_uri.startswith("s3://")
-    _, _, rest = s3_uri.partition("s3://")
-    bucket, _, key = rest.partition("/")
-    obj = s3.get_object(Bucket=bucket, Key=key)
-
-    pos = 0
-    neg = 0
-    for line in obj["Body"].iter_lines():
-        if not line:
-            continue
-        # first value before comma is label
-        first = line.split(b",", 1)[0]
-        if first == b"1" or first == b"1.0":
-            pos += 1
-        else:
-            neg += 1
+    path = s3_uri[len("s3://"):]
+
+    with fs.open_input_stream(path) as f:
+        tbl = pacsv.read_csv(
+            f,
+            read_options=pacsv.ReadOptions(autogenerate_column_names=True, use_threads=True),
+            convert_options=pacsv.ConvertOptions(
+                include_columns=["f0"],
+                column_types={"f0": pa.float32()},
+            ),
+        )
+
+    y = tbl["f0"].to_numpy()
+    pos = int((y == 1).sum())
+    neg = y.size - pos
 
     if pos == 0:
         return 1.0